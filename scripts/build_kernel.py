@@ -0,0 +1,34 @@
+# Compile our Numba kernel ahead of time
+#     Copyright (C) 2021  Rick Eichhorn: rickapps@live.com
+
+#     This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Run this where Numba is installed:
+#     python build_kernel.py
+# It writes a mandelbrot_aot extension module next to this file. Copy
+# it to a server without Numba and mandelbrot.py uses it instead of
+# its NumPy kernel. Numba is only needed to build it, not to run it.
+import os
+from numba.pycc import CC
+from mandelbrot import _escapeNumba
+
+cc = CC('mandelbrot_aot')
+cc.output_dir = os.path.dirname(os.path.abspath(__file__))
+# Same signature mandelbrot.py gives njit. Compiling ahead of time
+# ignores prange and fastmath, so this runs on one core and is slower
+# than the JIT kernel.
+cc.export('escape', 'void(f8,f8,f8,f8,i8,i8,i4,u2[:,::1])')(_escapeNumba)
+
+if __name__ == "__main__":
+    cc.compile()
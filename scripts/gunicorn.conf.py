@@ -0,0 +1,39 @@
+# gunicorn settings for the Mandelbrot Flask app
+#     Copyright (C) 2021  Rick Eichhorn: rickapps@live.com
+
+#     This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import os
+
+# App Engine tells us which port to use
+bind = ':' + os.environ.get('PORT', '8080')
+# Our C and Numba kernels draw each plot on every core, so a few
+# worker processes are enough. The NumPy kernel uses one core, so two
+# workers draw at most two plots at once. Without a compiled kernel,
+# set WEB_CONCURRENCY to the number of cores.
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+# One request at a time per worker. Without TBB or OpenMP, Numba's
+# parallel kernel aborts the process if two threads call it at once.
+worker_class = 'sync'
+threads = 1
+# Load the app, and compile our kernel, once before we fork
+preload_app = True
+
+def post_fork(server, worker):
+    # Don't share the master's database connection to our plot
+    # cache. The worker opens its own the first time it is used.
+    import main
+    main._plotCache.close()
+    # Make a plot so each worker has its kernel and thread pool
+    # ready before its first request
+    main.Mandelbrot(-0.65, 0.0, 3.4).makePngBytes()
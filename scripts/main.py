@@ -1,6 +1,6 @@
-# Flask route
-# Generate Mandelbrot set. Return it as a string that can be 
-# passed to an html img tag
+# Flask routes
+# Show plots of the Mandelbrot set. Pages give each plot as a url
+# to a PNG image, which our /img route draws and serves.
 #     Copyright (C) 2021  Rick Eichhorn: rickapps@live.com
 
 #     This program is free software: you can redistribute it and/or modify
@@ -15,29 +15,82 @@
 
 #     You should have received a copy of the GNU General Public License
 #     along with this program.  If not, see <https://www.gnu.org/licenses/>.
-from flask import Flask, render_template, request, session, redirect, url_for
-from mandelbrot import Mandelbrot
+import getpass
+import math
+import os
+import stat
+import tempfile
+from diskcache import Cache
+from flask import Flask, render_template, request, session, redirect, url_for, \
+    Response, abort
+from mandelbrot import Mandelbrot, RENDER_VERSION
 
 app = Flask(__name__)
 app.secret_key = 'MaNdElBrOtPlOt'
 _defaultImage = '/static/img/mandelbrot.png'
+_defaultPlot = (-0.65, 0.0, 3.4)  # xc, yc and domain of _defaultImage
+_maxPages = 32  # Number of plots we remember for previous/next
+
+def _cacheDir():
+    # diskcache unpickles what it reads back, so nobody else may be
+    # able to write to our cache. Use a directory only we can open.
+    # Anyone can create a directory in the temp folder before us, so
+    # check who owns it rather than trusting the name.
+    user = os.getuid() if hasattr(os, 'getuid') else getpass.getuser()
+    path = os.path.join(tempfile.gettempdir(), 'mandelbrot-plots-%s' % user)
+    try:
+        os.makedirs(path, mode=0o700, exist_ok=True)
+        info = os.lstat(path)
+        if stat.S_ISDIR(info.st_mode) and (not hasattr(os, 'getuid') or
+                (info.st_uid == os.getuid() and info.st_mode & 0o077 == 0)):
+            return path
+    except OSError:
+        pass
+    # Somebody else has our name. Use a fresh private directory.
+    return tempfile.mkdtemp(prefix='mandelbrot-plots-')
+
+# Plots we have already made. It lives on disk so every gunicorn
+# worker shares it. Oldest plots are dropped past 64 MB.
+_plotCache = Cache(_cacheDir(), size_limit=2**26)
+
+# Plots are stored under our render version, so we never serve one
+# drawn with other dims, iterations, colors or kernels.
+@_plotCache.memoize(name='render-' + RENDER_VERSION)
+def _render(xc, yc, domain):
+    # Under one render version the same params always give the same
+    # plot. Keep them so previous/next and page refreshes don't
+    # recalculate them.
+    return Mandelbrot(xc, yc, domain).makePngBytes()
+
+def _plotKey(xc, yc, domain):
+    # The url holds our render version and the params, so it names
+    # one image only. Round the params so floats that differ only in
+    # their last digit share a url.
+    return '_'.join([RENDER_VERSION] + ['%.15g' % v for v in (xc, yc, domain)])
+
+def renderPlot(xc, yc, domain):
+    # Return the url of our plot image. We already have an image
+    # for the default plot, so don't calculate it.
+    if (xc, yc, domain) == _defaultPlot:
+        return _defaultImage
+    return url_for('plotImage', key=_plotKey(xc, yc, domain))
 
 def manageSession(page, xc, yc, domain):
     # Populate our session dictionary
-    session['page'] = page
     if page == 0:
         session['xc'] = [xc]
         session['yc'] = [yc]
         session['domain'] = [domain]
     else:
-        # Delete everything past the current page
-        if page < len(session['xc']):
-            session['xc'] = [session['xc'][i] for i in range(page)]
-            session['yc'] = [session['yc'][i] for i in range(page)]
-            session['domain'] = [session['domain'][i] for i in range(page)]
-        session['xc'].append(xc)
-        session['yc'].append(yc)
-        session['domain'].append(domain) 
+        # Delete everything past the current page and add our new
+        # page. Keep only the most recent _maxPages so our session
+        # cookie stays small.
+        first = max(0, page + 1 - _maxPages)
+        session['xc'] = session['xc'][first:page] + [xc]
+        session['yc'] = session['yc'][first:page] + [yc]
+        session['domain'] = session['domain'][first:page] + [domain]
+        page -= first
+    session['page'] = page
 
 @app.route("/", methods=["POST","GET"])
 def plotView():
@@ -58,7 +111,7 @@ def plotView():
         plot.zoom(xcorner, ycorner, xcenter, ycenter)
 
         # Create our image and store the params used to make it
-        thePlot = plot.makeImage()
+        thePlot = renderPlot(plot.xc, plot.yc, plot.domain)
         xc = plot.xc
         yc = plot.yc
         domain = plot.domain
@@ -67,13 +120,8 @@ def plotView():
     else:
         # Display the default plot
         page = 0
-        xc = -0.65
-        yc = 0.0
-        domain = 3.4
-        #plot = Mandelbrot(xc, yc, domain)
-        # To make the initial display faster, we will just
-        # load an image.
-        thePlot = _defaultImage
+        xc, yc, domain = _defaultPlot
+        thePlot = renderPlot(xc, yc, domain)
         # Store our session
         manageSession(page, xc, yc, domain)
 
@@ -94,12 +142,8 @@ def plotSaved(num=0):
         yc = session['yc'][num]
         domain = session['domain'][num]
 
-        # Initialize our plot object
-        if num > 0:
-            plot = Mandelbrot(xc, yc, domain)
-            thePlot = plot.makeImage()
-        else:
-            thePlot = _defaultImage
+        # Get our plot
+        thePlot = renderPlot(xc, yc, domain)
 
         # Display our image and store values for the next plot
         return render_template("index.html", 
@@ -110,5 +154,28 @@ def plotSaved(num=0):
     else:
             return redirect(url_for('plotView'))
 
+@app.route("/img/<key>.png", methods=["GET"])
+def plotImage(key):
+    # Calculate the plot named by the url from renderPlot
+    try:
+        version, xc, yc, domain = key.split('_')
+        xc, yc, domain = float(xc), float(yc), float(domain)
+    except ValueError:
+        abort(404)
+    # Params we can't plot are not ours. Don't draw them or add them
+    # to the cache.
+    if domain <= 0 or not all(math.isfinite(v) for v in (xc, yc, domain)):
+        abort(404)
+    # Pages cached from before our last deploy still have urls from
+    # an older render version. Send them to the url we use now.
+    if version != RENDER_VERSION:
+        return redirect(url_for('plotImage', key=_plotKey(xc, yc, domain)))
+    response = Response(_render(xc, yc, domain), mimetype='image/png')
+    # Our image for this url never changes. Let the browser keep it.
+    response.cache_control.public = True
+    response.cache_control.max_age = 31536000
+    response.set_etag(key)
+    return response.make_conditional(request)
+
 if __name__ == "__main__":
     app.run()
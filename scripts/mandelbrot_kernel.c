@@ -0,0 +1,506 @@
+/*  mandelbrot_kernel.c - Escape time kernel for mandelbrot.py
+    Copyright (C) 2021  Rick Eichhorn: rickapps@live.com
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+    Optional. mandelbrot.py loads it with ctypes when it has been built:
+        gcc -O3 -shared -fPIC -o mandelbrot_kernel.so mandelbrot_kernel.c
+    No -m flags are needed. Each version of the kernel is compiled for
+    its own instruction set and escape() picks one when it is called.
+    Every version rounds exactly as the scalar one does, so a plot
+    comes out the same on any cpu.
+
+    The vector kernels keep the real and imaginary parts of a group of
+    pixels in separate registers, so no shuffles are needed to get at
+    them. A row's pixels are worked out from xMin as we go, and nothing
+    but the counts is ever stored to memory.
+*/
+#include <stdint.h>
+#include <immintrin.h>
+
+/* A fused multiply-add rounds once where a multiply and an add round
+   twice. Don't let the compiler fuse them in some versions of the
+   kernel and not in others. */
+#if defined(__clang__)
+#pragma STDC FP_CONTRACT OFF
+#elif defined(__GNUC__)
+#pragma GCC optimize("fp-contract=off")
+#endif
+
+/* Bump this, and _kernelAbi in mandelbrot.py, whenever the functions
+   we export or their arguments change. mandelbrot.py won't call a
+   kernel built from an older copy of this file. */
+#define KERNEL_ABI 4
+
+/* Scalar version for the columns left over at the end of a row */
+static uint16_t escape_one(double cx, double cy, int maxIter)
+{
+    /* Points inside the main cardioid or the period-2 bulb never diverge */
+    double q = (cx - 0.25) * (cx - 0.25) + cy * cy;
+    if (q * (q + (cx - 0.25)) < 0.25 * cy * cy ||
+        (cx + 1.0) * (cx + 1.0) + cy * cy < 0.0625)
+        return (uint16_t)maxIter;
+    /* Keep the squares for both the test and the next term */
+    double x = cx, y = cy, xx = x * x, yy = y * y;
+    int i = 0;
+    while (i < maxIter && xx + yy <= 4.0) {
+        y = 2.0 * x * y + cy;
+        x = xx - yy + cx;
+        xx = x * x;
+        yy = y * y;
+        i++;
+    }
+    return (uint16_t)i;
+}
+
+/* For cpus without AVX2 */
+static void escape_scalar(double xMin, double yMax, double xScale, double yScale,
+                          int row0, int W, int H, int maxIter, uint16_t *out)
+{
+    for (int row = 0; row < H; row++) {
+        double cy = yMax + (row0 + row) * yScale;
+        uint16_t *line = out + (int64_t)row * W;
+        for (int col = 0; col < W; col++)
+            line[col] = escape_one(xMin + col * xScale, cy, maxIter);
+    }
+}
+
+/* Vectors a block iterates together. Their series don't depend on
+   each other, so the cpu can work on one vector's multiplies while it
+   waits for another's to finish, instead of stalling on a single chain
+   of multiplies. Past four we run short of registers. */
+#define BLOCK 4
+
+/* Same result as _escapeNumba in mandelbrot.py. Iterate V vectors of
+   four pixels each, starting at column col, one pixel per lane. The
+   block stops when all of its pixels have diverged. V is a constant
+   wherever this is inlined, so the loops over v unroll away. */
+__attribute__((target("avx2"), always_inline))
+static inline void block_avx2(int V, double xMin, double xScale, double cy,
+                              int col, int maxIter, uint16_t *line)
+{
+    const __m256d _two = _mm256_set1_pd(2.0);
+    const __m256d _four = _mm256_set1_pd(4.0);
+    const __m256d _quarter = _mm256_set1_pd(0.25);
+    const __m256d _one = _mm256_set1_pd(1.0);
+    const __m256d _sixteenth = _mm256_set1_pd(0.0625);
+    const __m256d _offsets = _mm256_setr_pd(0.0, 1.0, 2.0, 3.0);
+    const __m256i _max = _mm256_set1_epi64x(maxIter);
+    /* Low 32 bits of each 64 bit lane */
+    const __m256i _pick32 = _mm256_setr_epi32(0, 2, 4, 6, 0, 2, 4, 6);
+    const __m256d _ci = _mm256_set1_pd(cy);
+    const __m256d _ci2 = _mm256_mul_pd(_ci, _ci);
+    __m256d _cr[BLOCK], _zr[BLOCK], _zi[BLOCK], _interior[BLOCK], _alive[BLOCK];
+    __m256i _n[BLOCK];
+
+    for (int v = 0; v < V; v++) {
+        /* xMin + column * xScale, as escape_one is given it */
+        _cr[v] = _mm256_add_pd(_mm256_set1_pd(xMin), _mm256_mul_pd(
+            _mm256_add_pd(_mm256_set1_pd(col + 4 * v), _offsets),
+            _mm256_set1_pd(xScale)));
+        /* Lanes inside the cardioid or the period-2 bulb are done
+           before we start */
+        __m256d _xq = _mm256_sub_pd(_cr[v], _quarter);
+        __m256d _q = _mm256_add_pd(_mm256_mul_pd(_xq, _xq), _ci2);
+        __m256d _cardioid = _mm256_cmp_pd(
+            _mm256_mul_pd(_q, _mm256_add_pd(_q, _xq)),
+            _mm256_mul_pd(_quarter, _ci2), _CMP_LT_OQ);
+        __m256d _xb = _mm256_add_pd(_cr[v], _one);
+        __m256d _bulb = _mm256_cmp_pd(
+            _mm256_add_pd(_mm256_mul_pd(_xb, _xb), _ci2), _sixteenth, _CMP_LT_OQ);
+        _interior[v] = _mm256_or_pd(_cardioid, _bulb);
+        _alive[v] = _mm256_andnot_pd(_interior[v], _mm256_castsi256_pd(
+            _mm256_set1_epi64x(-1)));
+        _zr[v] = _cr[v];
+        _zi[v] = _ci;
+        _n[v] = _mm256_setzero_si256();
+    }
+
+    for (int i = 0; i < maxIter; i++) {
+        __m256d _any = _mm256_setzero_pd();
+        for (int v = 0; v < V; v++) {
+            __m256d _zr2 = _mm256_mul_pd(_zr[v], _zr[v]);
+            __m256d _zi2 = _mm256_mul_pd(_zi[v], _zi[v]);
+            __m256d _mask = _mm256_cmp_pd(_mm256_add_pd(_zr2, _zi2), _four, _CMP_LE_OQ);
+            _alive[v] = _mm256_and_pd(_alive[v], _mask);
+            _any = _mm256_or_pd(_any, _alive[v]);
+            /* Live lanes are all ones, which is -1, so subtracting counts them */
+            _n[v] = _mm256_sub_epi64(_n[v], _mm256_castpd_si256(_alive[v]));
+            __m256d _a = _mm256_add_pd(_mm256_sub_pd(_zr2, _zi2), _cr[v]);
+            _zi[v] = _mm256_add_pd(_mm256_mul_pd(_mm256_mul_pd(_two, _zr[v]), _zi[v]), _ci);
+            _zr[v] = _a;
+        }
+        if (_mm256_movemask_pd(_any) == 0)
+            break;
+    }
+
+    for (int v = 0; v < V; v++) {
+        __m256i _count = _mm256_castpd_si256(_mm256_blendv_pd(
+            _mm256_castsi256_pd(_n[v]), _mm256_castsi256_pd(_max), _interior[v]));
+        /* Pack our four 64 bit counts down to uint16 and store
+           them together */
+        __m128i _n32 = _mm256_castsi256_si128(
+            _mm256_permutevar8x32_epi32(_count, _pick32));
+        _mm_storel_epi64((__m128i *)(line + col + 4 * v), _mm_packus_epi32(_n32, _n32));
+    }
+}
+
+__attribute__((target("avx2")))
+static void escape_avx2(double xMin, double yMax, double xScale, double yScale,
+                        int row0, int W, int H, int maxIter, uint16_t *out)
+{
+    for (int row = 0; row < H; row++) {
+        double cy = yMax + (row0 + row) * yScale;
+        uint16_t *line = out + (int64_t)row * W;
+        int col = 0;
+        for (; col + 4 * BLOCK <= W; col += 4 * BLOCK)
+            block_avx2(BLOCK, xMin, xScale, cy, col, maxIter, line);
+        for (; col + 4 <= W; col += 4)
+            block_avx2(1, xMin, xScale, cy, col, maxIter, line);
+        for (; col < W; col++)
+            line[col] = escape_one(xMin + col * xScale, cy, maxIter);
+    }
+}
+
+/* Eight pixels per vector. AVX-512 gives each lane its own mask bit,
+   so lanes that have diverged simply stop updating. */
+__attribute__((target("avx512f"), always_inline))
+static inline void block_avx512(int V, double xMin, double xScale, double cy,
+                                int col, int maxIter, uint16_t *line)
+{
+    const __m512d _two = _mm512_set1_pd(2.0);
+    const __m512d _four = _mm512_set1_pd(4.0);
+    const __m512d _quarter = _mm512_set1_pd(0.25);
+    const __m512d _one = _mm512_set1_pd(1.0);
+    const __m512d _sixteenth = _mm512_set1_pd(0.0625);
+    const __m512d _offsets = _mm512_setr_pd(0.0, 1.0, 2.0, 3.0, 4.0, 5.0, 6.0, 7.0);
+    const __m512i _count = _mm512_set1_epi64(1);
+    const __m512i _max = _mm512_set1_epi64(maxIter);
+    const __m512d _ci = _mm512_set1_pd(cy);
+    const __m512d _ci2 = _mm512_mul_pd(_ci, _ci);
+    __m512d _cr[BLOCK], _zr[BLOCK], _zi[BLOCK];
+    __m512i _n[BLOCK];
+    __mmask8 _interior[BLOCK], _alive[BLOCK];
+
+    for (int v = 0; v < V; v++) {
+        _cr[v] = _mm512_add_pd(_mm512_set1_pd(xMin), _mm512_mul_pd(
+            _mm512_add_pd(_mm512_set1_pd(col + 8 * v), _offsets),
+            _mm512_set1_pd(xScale)));
+        /* Lanes inside the cardioid or the period-2 bulb are done
+           before we start */
+        __m512d _xq = _mm512_sub_pd(_cr[v], _quarter);
+        __m512d _q = _mm512_add_pd(_mm512_mul_pd(_xq, _xq), _ci2);
+        _interior[v] = _mm512_cmp_pd_mask(
+            _mm512_mul_pd(_q, _mm512_add_pd(_q, _xq)),
+            _mm512_mul_pd(_quarter, _ci2), _CMP_LT_OQ);
+        __m512d _xb = _mm512_add_pd(_cr[v], _one);
+        _interior[v] |= _mm512_cmp_pd_mask(_mm512_add_pd(_mm512_mul_pd(_xb, _xb), _ci2),
+            _sixteenth, _CMP_LT_OQ);
+        _alive[v] = (__mmask8)~_interior[v];
+        _zr[v] = _cr[v];
+        _zi[v] = _ci;
+        _n[v] = _mm512_setzero_si512();
+    }
+
+    for (int i = 0; i < maxIter; i++) {
+        __mmask8 _any = 0;
+        for (int v = 0; v < V; v++) {
+            __m512d _zr2 = _mm512_mul_pd(_zr[v], _zr[v]);
+            __m512d _zi2 = _mm512_mul_pd(_zi[v], _zi[v]);
+            _alive[v] &= _mm512_cmp_pd_mask(_mm512_add_pd(_zr2, _zi2), _four, _CMP_LE_OQ);
+            _any |= _alive[v];
+            _n[v] = _mm512_mask_add_epi64(_n[v], _alive[v], _n[v], _count);
+            __m512d _xy = _mm512_mul_pd(_mm512_mul_pd(_two, _zr[v]), _zi[v]);
+            _zr[v] = _mm512_mask_add_pd(_zr[v], _alive[v], _mm512_sub_pd(_zr2, _zi2), _cr[v]);
+            _zi[v] = _mm512_mask_add_pd(_zi[v], _alive[v], _xy, _ci);
+        }
+        if (!_any)
+            break;
+    }
+
+    for (int v = 0; v < V; v++) {
+        _n[v] = _mm512_mask_mov_epi64(_n[v], _interior[v], _max);
+        _mm_storeu_si128((__m128i *)(line + col + 8 * v), _mm512_cvtepi64_epi16(_n[v]));
+    }
+}
+
+__attribute__((target("avx512f")))
+static void escape_avx512(double xMin, double yMax, double xScale, double yScale,
+                          int row0, int W, int H, int maxIter, uint16_t *out)
+{
+    for (int row = 0; row < H; row++) {
+        double cy = yMax + (row0 + row) * yScale;
+        uint16_t *line = out + (int64_t)row * W;
+        int col = 0;
+        for (; col + 8 * BLOCK <= W; col += 8 * BLOCK)
+            block_avx512(BLOCK, xMin, xScale, cy, col, maxIter, line);
+        for (; col + 8 <= W; col += 8)
+            block_avx512(1, xMin, xScale, cy, col, maxIter, line);
+        for (; col < W; col++)
+            line[col] = escape_one(xMin + col * xScale, cy, maxIter);
+    }
+}
+
+/* The same kernels in single precision. Twice as many pixels fit in
+   a vector, but float32 can only tell our pixels apart while they are
+   not too close together. mandelbrot.py decides when to use them. */
+static uint16_t escape_one32(float cx, float cy, int maxIter)
+{
+    float q = (cx - 0.25f) * (cx - 0.25f) + cy * cy;
+    if (q * (q + (cx - 0.25f)) < 0.25f * cy * cy ||
+        (cx + 1.0f) * (cx + 1.0f) + cy * cy < 0.0625f)
+        return (uint16_t)maxIter;
+    float x = cx, y = cy, xx = x * x, yy = y * y;
+    int i = 0;
+    while (i < maxIter && xx + yy <= 4.0f) {
+        y = 2.0f * x * y + cy;
+        x = xx - yy + cx;
+        xx = x * x;
+        yy = y * y;
+        i++;
+    }
+    return (uint16_t)i;
+}
+
+static void escape32_scalar(double xMin, double yMax, double xScale, double yScale,
+                            int row0, int W, int H, int maxIter, uint16_t *out)
+{
+    for (int row = 0; row < H; row++) {
+        float cy = (float)(yMax + (row0 + row) * yScale);
+        uint16_t *line = out + (int64_t)row * W;
+        for (int col = 0; col < W; col++)
+            line[col] = escape_one32((float)(xMin + col * xScale), cy, maxIter);
+    }
+}
+
+/* Eight pixels per AVX2 vector */
+__attribute__((target("avx2"), always_inline))
+static inline void block32_avx2(int V, double xMin, double xScale, float cy,
+                                int col, int maxIter, uint16_t *line)
+{
+    const __m256 _two = _mm256_set1_ps(2.0f);
+    const __m256 _four = _mm256_set1_ps(4.0f);
+    const __m256 _quarter = _mm256_set1_ps(0.25f);
+    const __m256 _one = _mm256_set1_ps(1.0f);
+    const __m256 _sixteenth = _mm256_set1_ps(0.0625f);
+    const __m256i _max = _mm256_set1_epi32(maxIter);
+    const __m256 _ci = _mm256_set1_ps(cy);
+    const __m256 _ci2 = _mm256_mul_ps(_ci, _ci);
+    __m256 _cr[BLOCK], _zr[BLOCK], _zi[BLOCK], _interior[BLOCK], _alive[BLOCK];
+    __m256i _n[BLOCK];
+
+    for (int v = 0; v < V; v++) {
+        /* Work out x in double precision, then round it once */
+        int c0 = col + 8 * v;
+        _cr[v] = _mm256_setr_ps((float)(xMin + c0 * xScale),
+            (float)(xMin + (c0 + 1) * xScale), (float)(xMin + (c0 + 2) * xScale),
+            (float)(xMin + (c0 + 3) * xScale), (float)(xMin + (c0 + 4) * xScale),
+            (float)(xMin + (c0 + 5) * xScale), (float)(xMin + (c0 + 6) * xScale),
+            (float)(xMin + (c0 + 7) * xScale));
+        __m256 _xq = _mm256_sub_ps(_cr[v], _quarter);
+        __m256 _q = _mm256_add_ps(_mm256_mul_ps(_xq, _xq), _ci2);
+        __m256 _cardioid = _mm256_cmp_ps(
+            _mm256_mul_ps(_q, _mm256_add_ps(_q, _xq)),
+            _mm256_mul_ps(_quarter, _ci2), _CMP_LT_OQ);
+        __m256 _xb = _mm256_add_ps(_cr[v], _one);
+        __m256 _bulb = _mm256_cmp_ps(
+            _mm256_add_ps(_mm256_mul_ps(_xb, _xb), _ci2), _sixteenth, _CMP_LT_OQ);
+        _interior[v] = _mm256_or_ps(_cardioid, _bulb);
+        _alive[v] = _mm256_andnot_ps(_interior[v], _mm256_castsi256_ps(
+            _mm256_set1_epi32(-1)));
+        _zr[v] = _cr[v];
+        _zi[v] = _ci;
+        _n[v] = _mm256_setzero_si256();
+    }
+
+    for (int i = 0; i < maxIter; i++) {
+        __m256 _any = _mm256_setzero_ps();
+        for (int v = 0; v < V; v++) {
+            __m256 _zr2 = _mm256_mul_ps(_zr[v], _zr[v]);
+            __m256 _zi2 = _mm256_mul_ps(_zi[v], _zi[v]);
+            __m256 _mask = _mm256_cmp_ps(_mm256_add_ps(_zr2, _zi2), _four, _CMP_LE_OQ);
+            _alive[v] = _mm256_and_ps(_alive[v], _mask);
+            _any = _mm256_or_ps(_any, _alive[v]);
+            _n[v] = _mm256_sub_epi32(_n[v], _mm256_castps_si256(_alive[v]));
+            __m256 _a = _mm256_add_ps(_mm256_sub_ps(_zr2, _zi2), _cr[v]);
+            _zi[v] = _mm256_add_ps(_mm256_mul_ps(_mm256_mul_ps(_two, _zr[v]), _zi[v]), _ci);
+            _zr[v] = _a;
+        }
+        if (_mm256_movemask_ps(_any) == 0)
+            break;
+    }
+
+    for (int v = 0; v < V; v++) {
+        __m256i _count = _mm256_castps_si256(_mm256_blendv_ps(
+            _mm256_castsi256_ps(_n[v]), _mm256_castsi256_ps(_max), _interior[v]));
+        /* packus works within each 128 bit half, so bring the two
+           halves' results together before storing */
+        __m256i _n16 = _mm256_permute4x64_epi64(_mm256_packus_epi32(_count, _count), 0x08);
+        _mm_storeu_si128((__m128i *)(line + col + 8 * v), _mm256_castsi256_si128(_n16));
+    }
+}
+
+__attribute__((target("avx2")))
+static void escape32_avx2(double xMin, double yMax, double xScale, double yScale,
+                          int row0, int W, int H, int maxIter, uint16_t *out)
+{
+    for (int row = 0; row < H; row++) {
+        float cy = (float)(yMax + (row0 + row) * yScale);
+        uint16_t *line = out + (int64_t)row * W;
+        int col = 0;
+        for (; col + 8 * BLOCK <= W; col += 8 * BLOCK)
+            block32_avx2(BLOCK, xMin, xScale, cy, col, maxIter, line);
+        for (; col + 8 <= W; col += 8)
+            block32_avx2(1, xMin, xScale, cy, col, maxIter, line);
+        for (; col < W; col++)
+            line[col] = escape_one32((float)(xMin + col * xScale), cy, maxIter);
+    }
+}
+
+/* Sixteen pixels per AVX-512 vector */
+__attribute__((target("avx512f"), always_inline))
+static inline void block32_avx512(int V, double xMin, double xScale, float cy,
+                                  int col, int maxIter, uint16_t *line)
+{
+    const __m512 _two = _mm512_set1_ps(2.0f);
+    const __m512 _four = _mm512_set1_ps(4.0f);
+    const __m512 _quarter = _mm512_set1_ps(0.25f);
+    const __m512 _one = _mm512_set1_ps(1.0f);
+    const __m512 _sixteenth = _mm512_set1_ps(0.0625f);
+    const __m512d _offsets = _mm512_setr_pd(0.0, 1.0, 2.0, 3.0, 4.0, 5.0, 6.0, 7.0);
+    const __m512d _scale = _mm512_set1_pd(xScale);
+    const __m512d _xMin = _mm512_set1_pd(xMin);
+    const __m512i _count = _mm512_set1_epi32(1);
+    const __m512i _max = _mm512_set1_epi32(maxIter);
+    const __m512 _ci = _mm512_set1_ps(cy);
+    const __m512 _ci2 = _mm512_mul_ps(_ci, _ci);
+    __m512 _cr[BLOCK], _zr[BLOCK], _zi[BLOCK];
+    __m512i _n[BLOCK];
+    __mmask16 _interior[BLOCK], _alive[BLOCK];
+
+    for (int v = 0; v < V; v++) {
+        /* Work out x in double precision, then round it once */
+        __m256 _lo = _mm512_cvtpd_ps(_mm512_add_pd(_xMin, _mm512_mul_pd(
+            _mm512_add_pd(_mm512_set1_pd(col + 16 * v), _offsets), _scale)));
+        __m256 _hi = _mm512_cvtpd_ps(_mm512_add_pd(_xMin, _mm512_mul_pd(
+            _mm512_add_pd(_mm512_set1_pd(col + 16 * v + 8), _offsets), _scale)));
+        _cr[v] = _mm512_castpd_ps(_mm512_insertf64x4(
+            _mm512_castpd256_pd512(_mm256_castps_pd(_lo)), _mm256_castps_pd(_hi), 1));
+        __m512 _xq = _mm512_sub_ps(_cr[v], _quarter);
+        __m512 _q = _mm512_add_ps(_mm512_mul_ps(_xq, _xq), _ci2);
+        _interior[v] = _mm512_cmp_ps_mask(
+            _mm512_mul_ps(_q, _mm512_add_ps(_q, _xq)),
+            _mm512_mul_ps(_quarter, _ci2), _CMP_LT_OQ);
+        __m512 _xb = _mm512_add_ps(_cr[v], _one);
+        _interior[v] |= _mm512_cmp_ps_mask(_mm512_add_ps(_mm512_mul_ps(_xb, _xb), _ci2),
+            _sixteenth, _CMP_LT_OQ);
+        _alive[v] = (__mmask16)~_interior[v];
+        _zr[v] = _cr[v];
+        _zi[v] = _ci;
+        _n[v] = _mm512_setzero_si512();
+    }
+
+    for (int i = 0; i < maxIter; i++) {
+        __mmask16 _any = 0;
+        for (int v = 0; v < V; v++) {
+            __m512 _zr2 = _mm512_mul_ps(_zr[v], _zr[v]);
+            __m512 _zi2 = _mm512_mul_ps(_zi[v], _zi[v]);
+            _alive[v] &= _mm512_cmp_ps_mask(_mm512_add_ps(_zr2, _zi2), _four, _CMP_LE_OQ);
+            _any |= _alive[v];
+            _n[v] = _mm512_mask_add_epi32(_n[v], _alive[v], _n[v], _count);
+            __m512 _xy = _mm512_mul_ps(_mm512_mul_ps(_two, _zr[v]), _zi[v]);
+            _zr[v] = _mm512_mask_add_ps(_zr[v], _alive[v], _mm512_sub_ps(_zr2, _zi2), _cr[v]);
+            _zi[v] = _mm512_mask_add_ps(_zi[v], _alive[v], _xy, _ci);
+        }
+        if (!_any)
+            break;
+    }
+
+    for (int v = 0; v < V; v++) {
+        _n[v] = _mm512_mask_mov_epi32(_n[v], _interior[v], _max);
+        _mm256_storeu_si256((__m256i *)(line + col + 16 * v), _mm512_cvtepi32_epi16(_n[v]));
+    }
+}
+
+__attribute__((target("avx512f")))
+static void escape32_avx512(double xMin, double yMax, double xScale, double yScale,
+                            int row0, int W, int H, int maxIter, uint16_t *out)
+{
+    for (int row = 0; row < H; row++) {
+        float cy = (float)(yMax + (row0 + row) * yScale);
+        uint16_t *line = out + (int64_t)row * W;
+        int col = 0;
+        for (; col + 16 * BLOCK <= W; col += 16 * BLOCK)
+            block32_avx512(BLOCK, xMin, xScale, cy, col, maxIter, line);
+        for (; col + 16 <= W; col += 16)
+            block32_avx512(1, xMin, xScale, cy, col, maxIter, line);
+        for (; col < W; col++)
+            line[col] = escape_one32((float)(xMin + col * xScale), cy, maxIter);
+    }
+}
+
+/* Called from mandelbrot.py before it uses our kernels */
+int escape_abi(void)
+{
+    return KERNEL_ABI;
+}
+
+/* Versions of our kernels. They all give the same counts, the wider
+   ones just give them sooner. */
+enum { PATH_SCALAR, PATH_AVX2, PATH_AVX512 };
+
+/* Use the widest vectors this cpu has */
+static int cpu_path(void)
+{
+    __builtin_cpu_init();
+    if (__builtin_cpu_supports("avx512f"))
+        return PATH_AVX512;
+    if (__builtin_cpu_supports("avx2"))
+        return PATH_AVX2;
+    return PATH_SCALAR;
+}
+
+/* Called from mandelbrot.py. out holds rows row0 to row0 + H - 1 of
+   the plot, and row zero is yMax. Each row's y is worked out from the
+   same yMax however mandelbrot.py splits the plot, so the counts never
+   depend on it. */
+void escape(double xMin, double yMax, double xScale, double yScale,
+            int row0, int W, int H, int maxIter, uint16_t *out)
+{
+    switch (cpu_path()) {
+    case PATH_AVX512:
+        escape_avx512(xMin, yMax, xScale, yScale, row0, W, H, maxIter, out);
+        break;
+    case PATH_AVX2:
+        escape_avx2(xMin, yMax, xScale, yScale, row0, W, H, maxIter, out);
+        break;
+    default:
+        escape_scalar(xMin, yMax, xScale, yScale, row0, W, H, maxIter, out);
+    }
+}
+
+void escape32(double xMin, double yMax, double xScale, double yScale,
+              int row0, int W, int H, int maxIter, uint16_t *out)
+{
+    switch (cpu_path()) {
+    case PATH_AVX512:
+        escape32_avx512(xMin, yMax, xScale, yScale, row0, W, H, maxIter, out);
+        break;
+    case PATH_AVX2:
+        escape32_avx2(xMin, yMax, xScale, yScale, row0, W, H, maxIter, out);
+        break;
+    default:
+        escape32_scalar(xMin, yMax, xScale, yScale, row0, W, H, maxIter, out);
+    }
+}